@@ -17,21 +17,24 @@ indeps = prob.model.add_subsystem('indeps', IndepVarComp())
 indeps.add_output('x', 3.0)
 indeps.add_output('y', -4.0)
 
-# Define the objective and the constraint functions
-prob.model.add_subsystem('paraboloid', ExecComp('f = (x-3)**2 + x*y + (y+4)**2 - 3'))
-prob.model.add_subsystem('con', ExecComp('c = x + y'))
+# Define the objective and the constraint functions in one component so a
+# single evaluation returns both of them.
+
+# Every output depends only on the matching entry of each input, so the
+# partials are diagonal and OpenMDAO can skip its sparsity detection.
+prob.model.add_subsystem('paraboloid', ExecComp(['f = (x-3)**2 + x*y + (y+4)**2 - 3',
+                                                 'c = x + y'],
+                                                has_diag_partials=True))
 
 # Connect the model
 prob.model.connect('indeps.x', 'paraboloid.x')
 prob.model.connect('indeps.y', 'paraboloid.y')
-prob.model.connect('indeps.x', 'con.x')
-prob.model.connect('indeps.y', 'con.y')
 
 # Define the optimization problem
 prob.model.add_design_var('indeps.x', lower=-50, upper=50)
 prob.model.add_design_var('indeps.y', lower=-50, upper=50)
 prob.model.add_objective('paraboloid.f')
-prob.model.add_constraint('con.c', lower=0.0)
+prob.model.add_constraint('paraboloid.c', lower=0.0)
 
 # Create the ParOpt driver
 prob.driver = ParOptDriver()
@@ -1,22 +1,97 @@
 import numpy as np
 import openmdao.api as om
 import dymos as dm
-import matplotlib
-matplotlib.use('tkAgg')
-import matplotlib.pyplot as plt
 import argparse
+import functools
+import math
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Acceleration of gravity (m/s**2)
+_G = 9.80665
+
+# The kernels evaluate cos and sin of the same angle back to back so that,
+# with fastmath enabled, LLVM can combine them into a single sincos call.
+# If Intel SVML is available to numba (install the icc_rt package) the
+# loops are also vectorized to __svml_sincos4 on AVX2, computing four
+# angles per instruction; check with `numba -s` that SVML is enabled.
+# A vectorized libm such as Sleef (Sleef_sincosd4_u10avx2 on AVX2 builds)
+# would be the next step beyond that.
+# The kernels are compiled eagerly at import for the given signatures and
+# cached on disk, so the first driver iteration does not pay for the JIT.
+# The signatures take C-contiguous arrays, which is what OpenMDAO's vector
+# views and sub-jacobian arrays are, so the loops can be vectorized.
+# Set NUMBA_CACHE_DIR to share the cache between runs, e.g. on CI.
+# The loops are serial: dymos only passes a few tens of nodes, too few to
+# pay for dispatching to a thread pool on every call.
+if njit is not None:
+    @njit('void(f8[::1], f8[::1], f8, f8[::1], f8[::1], f8[::1])',
+          fastmath=True, cache=True)
+    def _brach_rhs(theta, v, g, vdot, xdot, ydot):
+        for i in range(theta.size):
+            c = math.cos(theta[i])
+            s = math.sin(theta[i])
+            vdot[i] = g * c
+            xdot[i] = v[i] * s
+            ydot[i] = -v[i] * c
+
+    @njit('void(f8[::1], f8[::1], f8, f8[::1], f8[::1], f8[::1], f8[::1], f8[::1])',
+          fastmath=True, cache=True)
+    def _brach_jac(theta, v, g, J_vdot_theta, J_xdot_v, J_xdot_theta,
+                   J_ydot_v, J_ydot_theta):
+        for i in range(theta.size):
+            c = math.cos(theta[i])
+            s = math.sin(theta[i])
+            J_vdot_theta[i] = -g * s
+            J_xdot_v[i] = s
+            J_xdot_theta[i] = v[i] * c
+            J_ydot_v[i] = -c
+            J_ydot_theta[i] = v[i] * s
+
+@functools.lru_cache(maxsize=None)
+def _make_jax_jac():
+    """
+    Build the JAX forward-mode derivatives of the pointwise right-hand side,
+    evaluated at every node at once. The returned function gives the
+    (vdot, xdot, ydot) derivatives with respect to theta and v, each of
+    shape (nn, 3). JAX is only imported when this is first called.
+    """
+    import jax
+    import jax.numpy as jnp
+    jax.config.update('jax_enable_x64', True)
+
+    def rhs(theta, v, g):
+        c = jnp.cos(theta)
+        s = jnp.sin(theta)
+        return jnp.stack([g * c, v * s, -v * c])
+
+    return jax.jit(jax.vmap(jax.jacfwd(rhs, argnums=(0, 1)), in_axes=(0, 0, None)))
 
 class BrachistochroneODE(om.ExplicitComponent):
 
     def initialize(self):
         self.options.declare('num_nodes', types=int)
+        self.options.declare('g', default=_G, types=float,
+                             desc='acceleration of gravity in m/s**2')
+        self.options.declare('partials_method', default='analytic',
+                             values=['analytic', 'jax'],
+                             desc='compute the partials analytically or with JAX')
 
     def setup(self):
         nn = self.options['num_nodes']
 
+        # Gravity is fixed for the problem, so keep it out of the inputs
+        self._g = self.options['g']
+
+        self._jax_jac = None
+        if self.options['partials_method'] == 'jax':
+            self._jax_jac = _make_jax_jac()
+
         # Inputs
         self.add_input('v', val=np.zeros(nn), desc='velocity', units='m/s')
-        self.add_input('g', val=9.80665, desc='acceleration of gravity', units='m/s**2')
         self.add_input('theta', val=np.zeros(nn), desc='angle of wire', units='rad')
         self.add_output('xdot', val=np.zeros(nn), desc='horizontal velocity', units='m/s')
         self.add_output('ydot', val=np.zeros(nn), desc='vertical velocity', units='m/s')
@@ -25,7 +100,6 @@ class BrachistochroneODE(om.ExplicitComponent):
         # Setup partials
         arange = np.arange(self.options['num_nodes'], dtype=int)
 
-        self.declare_partials(of='vdot', wrt='g', rows=arange, cols=np.zeros(nn, dtype=int))
         self.declare_partials(of='vdot', wrt='theta', rows=arange, cols=arange)
 
         self.declare_partials(of='xdot', wrt='v', rows=arange, cols=arange)
@@ -34,32 +108,100 @@ class BrachistochroneODE(om.ExplicitComponent):
         self.declare_partials(of='ydot', wrt='v', rows=arange, cols=arange)
         self.declare_partials(of='ydot', wrt='theta', rows=arange, cols=arange)
 
+        # Without numba, keep the trig values from the last call and reuse them
+        # when theta is unchanged. The numba kernels evaluate sin and cos in
+        # the same pass as the outputs, so they do not use this cache.
+        self._trig_valid = False
+        if njit is None:
+            self._theta_cache = np.empty(nn)
+            self._theta_equal = np.empty(nn, dtype=bool)
+            self._cos = np.empty(nn)
+            self._sin = np.empty(nn)
+
+        # Sub-jacobian arrays, resolved on the first call to compute_partials
+        self._jac_owner = None
+        self._jac_views = None
+
+    def _trig(self, theta):
+        np.equal(theta, self._theta_cache, out=self._theta_equal)
+        if not self._trig_valid or not self._theta_equal.all():
+            np.copyto(self._theta_cache, theta)
+            np.cos(theta, out=self._cos)
+            np.sin(theta, out=self._sin)
+            self._trig_valid = True
+        return self._cos, self._sin
+
+    def _views(self, jacobian):
+        # The sub-jacobian storage is only allocated after setup, so look the
+        # arrays up once per jacobian and write into them in place afterwards
+        if jacobian is not self._jac_owner:
+            self._jac_owner = jacobian
+            self._jac_views = (jacobian['vdot', 'theta'],
+                               jacobian['xdot', 'v'], jacobian['xdot', 'theta'],
+                               jacobian['ydot', 'v'], jacobian['ydot', 'theta'])
+        return self._jac_views
+
     def compute(self, inputs, outputs):
         theta = inputs['theta']
-        cos_theta = np.cos(theta)
-        sin_theta = np.sin(theta)
-        g = inputs['g']
+        if np.iscomplexobj(theta):
+            # Complex step, e.g. check_partials(method='cs'), only calls
+            # compute; the kernels and the trig buffers are real-valued, so
+            # use plain NumPy instead
+            v = inputs['v']
+            outputs['vdot'] = self._g * np.cos(theta)
+            outputs['xdot'] = v * np.sin(theta)
+            outputs['ydot'] = -v * np.cos(theta)
+            return
+
+        if njit is not None:
+            # Evaluate the right-hand side in place in a single pass
+            _brach_rhs(theta, inputs['v'], self._g,
+                       outputs['vdot'], outputs['xdot'], outputs['ydot'])
+            return
+
+        cos_theta, sin_theta = self._trig(theta)
+        g = self._g
         v = inputs['v']
 
-        outputs['vdot'] = g * cos_theta
-        outputs['xdot'] = v * sin_theta
-        outputs['ydot'] = -v * cos_theta
+        np.multiply(g, cos_theta, out=outputs['vdot'])
+        np.multiply(v, sin_theta, out=outputs['xdot'])
+        np.multiply(v, cos_theta, out=outputs['ydot'])
+        np.negative(outputs['ydot'], out=outputs['ydot'])
 
     def compute_partials(self, inputs, jacobian):
+        J_vdot_theta, J_xdot_v, J_xdot_theta, J_ydot_v, J_ydot_theta = self._views(jacobian)
+
+        if self._jax_jac is not None:
+            d_theta, d_v = self._jax_jac(inputs['theta'], inputs['v'], self._g)
+            d_theta = np.asarray(d_theta)
+            d_v = np.asarray(d_v)
+
+            np.copyto(J_vdot_theta, d_theta[:, 0])
+            np.copyto(J_xdot_v, d_v[:, 1])
+            np.copyto(J_xdot_theta, d_theta[:, 1])
+            np.copyto(J_ydot_v, d_v[:, 2])
+            np.copyto(J_ydot_theta, d_theta[:, 2])
+            return
+
+        if njit is not None:
+            # The partials are all diagonal, so write them straight into
+            # the sparse sub-jacobian storage in a single pass
+            _brach_jac(inputs['theta'], inputs['v'], self._g,
+                       J_vdot_theta, J_xdot_v, J_xdot_theta, J_ydot_v, J_ydot_theta)
+            return
+
         theta = inputs['theta']
-        cos_theta = np.cos(theta)
-        sin_theta = np.sin(theta)
-        g = inputs['g']
+        cos_theta, sin_theta = self._trig(theta)
+        g = self._g
         v = inputs['v']
 
-        jacobian['vdot', 'g'] = cos_theta
-        jacobian['vdot', 'theta'] = -g * sin_theta
+        np.multiply(-g, sin_theta, out=J_vdot_theta)
 
-        jacobian['xdot', 'v'] = sin_theta
-        jacobian['xdot', 'theta'] = v * cos_theta
+        np.copyto(J_xdot_v, sin_theta)
+        np.multiply(v, cos_theta, out=J_xdot_theta)
 
-        jacobian['ydot', 'v'] = -cos_theta
-        jacobian['ydot', 'theta'] = v * sin_theta
+        np.negative(cos_theta, out=J_ydot_v)
+        np.multiply(v, sin_theta, out=J_ydot_theta)
 
 # Add options
 parser = argparse.ArgumentParser()
@@ -67,6 +209,13 @@ parser.add_argument('--optimizer', default='ParOpt',
                     help='Optimizer name from pyOptSparse')
 parser.add_argument('--algorithm', default='tr',
                     help='Optimizer name from pyOptSparse')
+parser.add_argument('--plot', action='store_true', default=False,
+                    help='Plot the solution against the simulation')
+parser.add_argument('--partials', default='analytic',
+                    choices=['analytic', 'jax'],
+                    help='Method used for the ODE partials')
+parser.add_argument('--check_partials', action='store_true', default=False,
+                    help='Check the ODE partials by complex step before optimizing')
 args = parser.parse_args()
 
 optimizer = args.optimizer
@@ -82,6 +231,7 @@ p.model.add_subsystem('traj', subsys=traj)
 
 # Define a Dymos Phase object with GaussLobatto Transcription
 phase = dm.Phase(ode_class=BrachistochroneODE,
+                 ode_init_kwargs={'partials_method': args.partials},
                  transcription=dm.GaussLobatto(num_segments=10, order=3))
 
 traj.add_phase(name='phase0', phase=phase)
@@ -112,6 +262,10 @@ phase.add_objective('time', loc='final')
 # Set the driver.
 p.driver = om.pyOptSparseDriver()
 
+# Compute the total derivative coloring once and reuse it so that the
+# sparsity of the collocation defects is exploited on every iteration.
+p.driver.declare_coloring(tol=1e-12, num_full_jacs=2, min_improve_pct=5.)
+
 if optimizer == 'SLSQP':
     p.driver.options['optimizer'] = 'SLSQP'
 
@@ -131,25 +285,29 @@ else:
 
 
 # Setup the problem
-p.setup(check=True)
+p.setup(check=True, force_alloc_complex=args.check_partials)
 
 # Now that the OpenMDAO problem is setup, we can set the values of the states.
-p.set_val('traj.phase0.states:x',
-          phase.interpolate(ys=[0, 10], nodes='state_input'),
-          units='m')
-
-p.set_val('traj.phase0.states:y',
-          phase.interpolate(ys=[10, 5], nodes='state_input'),
-          units='m')
-
-p.set_val('traj.phase0.states:v',
-          phase.interpolate(ys=[0, 5], nodes='state_input'),
-          units='m/s')
-
-p.set_val('traj.phase0.controls:theta',
-          phase.interpolate(ys=[90, 90], nodes='control_input'),
+# The initial guesses are linear between the end points, so locate the state
+# input nodes once and reuse them rather than interpolating for each state.
+grid_data = phase.options['transcription'].grid_data
+state_tau = grid_data.node_ptau[grid_data.subset_node_indices['state_input']]
+state_frac = 0.5 * (state_tau[:, np.newaxis] + 1.0)
+
+p.set_val('traj.phase0.states:x', 0.0 + 10.0 * state_frac, units='m')
+p.set_val('traj.phase0.states:y', 10.0 - 5.0 * state_frac, units='m')
+p.set_val('traj.phase0.states:v', 0.0 + 5.0 * state_frac, units='m/s')
+
+# The initial control guess is constant, so fill it directly
+num_control_nodes = grid_data.subset_num_nodes['control_input']
+p.set_val('traj.phase0.controls:theta', np.full((num_control_nodes, 1), 90.0),
           units='deg')
 
+# Compare the ODE partials against complex step at the initial guess
+if args.check_partials:
+    p.run_model()
+    p.check_partials(includes=['*rhs*'], method='cs', compact_print=True)
+
 # Run the driver to solve the problem
 p.run_driver()
 
@@ -157,33 +315,39 @@ p.run_driver()
 # integrate the solution.
 sim_out = traj.simulate()
 
-# Plot the results
-fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(12, 4.5))
+if args.plot:
+    import matplotlib
+    matplotlib.use('tkAgg')
+    import matplotlib.pyplot as plt
+
+    # Plot the results
+    fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(12, 4.5))
 
-axes[0].plot(p.get_val('traj.phase0.timeseries.states:x'),
-             p.get_val('traj.phase0.timeseries.states:y'),
-             'ro', label='solution')
+    axes[0].plot(p.get_val('traj.phase0.timeseries.states:x'),
+                 p.get_val('traj.phase0.timeseries.states:y'),
+                 'ro', label='solution')
 
-axes[0].plot(sim_out.get_val('traj.phase0.timeseries.states:x'),
-             sim_out.get_val('traj.phase0.timeseries.states:y'),
-             'b-', label='simulation')
+    axes[0].plot(sim_out.get_val('traj.phase0.timeseries.states:x'),
+                 sim_out.get_val('traj.phase0.timeseries.states:y'),
+                 'b-', label='simulation')
 
-axes[0].set_xlabel('x (m)')
-axes[0].set_ylabel('y (m/s)')
-axes[0].legend()
-axes[0].grid()
+    axes[0].set_xlabel('x (m)')
+    axes[0].set_ylabel('y (m/s)')
+    axes[0].legend()
+    axes[0].grid()
 
-axes[1].plot(p.get_val('traj.phase0.timeseries.time'),
-             p.get_val('traj.phase0.timeseries.controls:theta', units='deg'),
-             'ro', label='solution')
+    # Convert the control to degrees directly rather than through a units lookup
+    axes[1].plot(p.get_val('traj.phase0.timeseries.time'),
+                 np.rad2deg(p.get_val('traj.phase0.timeseries.controls:theta')),
+                 'ro', label='solution')
 
-axes[1].plot(sim_out.get_val('traj.phase0.timeseries.time'),
-             sim_out.get_val('traj.phase0.timeseries.controls:theta', units='deg'),
-             'b-', label='simulation')
+    axes[1].plot(sim_out.get_val('traj.phase0.timeseries.time'),
+                 np.rad2deg(sim_out.get_val('traj.phase0.timeseries.controls:theta')),
+                 'b-', label='simulation')
 
-axes[1].set_xlabel('time (s)')
-axes[1].set_ylabel(r'$\theta$ (deg)')
-axes[1].legend()
-axes[1].grid()
+    axes[1].set_xlabel('time (s)')
+    axes[1].set_ylabel(r'$\theta$ (deg)')
+    axes[1].legend()
+    axes[1].grid()
 
-plt.show()
\ No newline at end of file
+    plt.show()